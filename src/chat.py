@@ -3,23 +3,30 @@
 #  Autor.........: Rogério Martins
 #  Descrição.....: Aplicação de chat para consulta em PDF ingerido
 #  Criado em.....: 25/10/2025
-#  Última alteração: 25/10/2025
+#  Última alteração: 15/10/2026
 # ==================================================================
 
 import os
 from dotenv import load_dotenv
 
+try:
+    # Habilita edição de linha e histórico no input() (disponível em *nix)
+    import readline  # noqa: F401
+except ImportError:
+    pass
+
 from search import search_prompt
 
 # Comandos de saída do chat
 EXIT_COMMANDS = {":q", ":quit", ":exit", ":sair"}
+_EXIT = frozenset(EXIT_COMMANDS)
 
 
 def main():
     load_dotenv()
 
     try:
-        chain = search_prompt()
+        chain = search_prompt(stream=True)
     except Exception as e:
         print(f"Não foi possível iniciar o chat. Verifique os erros de inicialização.\nDetalhes: {e}")
         return
@@ -37,29 +44,26 @@ def main():
 
     while True:
         try:
-            # Captura a entrada do usuário (pergunta ou comando)
-            q = input("> ").strip()
+            # Captura a entrada do usuário (pergunta ou comando), ignorando entradas vazias
+            if not (q := input("> ").strip()):
+                continue
         except (EOFError, KeyboardInterrupt):
             print("\nEncerrando...")
             break
-        
-        # Ignora entradas vazias
-        if not q:
-            continue
-        
+
         # Encerra o loop se o usuário digitar um comando de saída
-        if q.lower() in EXIT_COMMANDS:
+        if q.casefold() in _EXIT:
             print("Tchau!")
             break
 
         try:
             #  Executa a busca / recuperação na base de dados da questão formulada pelo usuário,
             # limitando os resultados aos top-k mais relevantes (onde topk=10).
-            #  Armazena a resposta na variável 'answer'.
-            answer = chain(q, k=topk)
+            #  Exibe a resposta à medida que a LLM gera os tokens.
             print("\n--- Resposta ---")
-            print(answer)
-            print("----------------\n")
+            for token in chain(q, k=topk):
+                print(token, end="", flush=True)
+            print("\n----------------\n")
         except Exception as e:
             print(f"[erro] {e}\n")
 
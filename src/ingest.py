@@ -3,16 +3,30 @@
 #  Autor.........: Rogério Martins
 #  Descrição.....: Script para ingestão de PDF e criação de índices no PGVector
 #  Criado em.....: 25/10/2025
-#  Última alteração: 25/10/2025
+#  Última alteração: 15/10/2026
 # =============================================================================
 
+import asyncio
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader
+from openai import RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_core.documents import Document
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain_postgres import PGVector
+from langchain_postgres.vectorstores import DistanceStrategy
+from pgvector.utils import HalfVector
+from pgvector.psycopg import register_vector_async
+from psycopg import AsyncConnection
+from psycopg.types.json import Jsonb
+from sqlalchemy.engine import make_url
+
+from search import normalize
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -23,40 +37,155 @@ for k in ("OPENAI_API_KEY", "DATABASE_URL","PGVECTOR_COLLECTION", "PDF_PATH"):
 # Caminho do PDF a ser ingerido
 PDF_PATH = os.environ["PDF_PATH"]
 
-def ingest_pdf():
-    # Carrega o PDF
-    loader = PyPDFLoader(PDF_PATH)
-    documents = loader.load()
-    
-    # Divide o documento em pedaços menores
-    splits = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150, add_start_index=False).split_documents(documents)
+# Divisor de texto usado em cada página (instanciado também em cada processo do pool)
+_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150, add_start_index=False)
+
+# Quantidade de textos enviados em cada chamada à API de embeddings (limite da OpenAI: 2048)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+
+# Máximo de chamadas de embeddings simultâneas (respeita o limite de tokens por minuto)
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "8"))
+
+# Dimensão dos vetores do modelo de embeddings (text-embedding-3-small: 1536)
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1536"))
+
+# Diretório do cache de embeddings em disco (chave: modelo + sha256 do texto)
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./.emb_cache")
+
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _embed_batch(embeddings, texts):
+    # Vetoriza um lote de pedaços, repetindo em caso de rate limit
+    return await embeddings.aembed_documents(texts)
+
+
+async def _embed_documents(embeddings, texts):
+    # Dispara os lotes em paralelo, limitados a EMBEDDING_CONCURRENCY chamadas simultâneas
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def run(batch):
+        async with semaphore:
+            return await _embed_batch(embeddings, batch)
+
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+    return [vector for result in results for vector in result]
+
+
+def _split_page(page):
+    # Divide uma página em pedaços (executado nos processos do pool)
+    return _SPLITTER.split_documents([page])
+
+
+def _load_splits():
+    # Lê o PDF página a página (PyMuPDF) e divide as páginas em paralelo, uma por tarefa
+    pages = PyMuPDFLoader(PDF_PATH).lazy_load()
+    with ProcessPoolExecutor() as ex:
+        return list(chain.from_iterable(ex.map(_split_page, pages, chunksize=8)))
+
+
+async def _prepare_schema(conn):
+    # Armazena os embeddings como halfvec (FP16): metade do espaço por linha e no índice HNSW
+    (column_type,) = await (await conn.execute(
+        "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'"
+    )).fetchone()
+    if column_type != f"halfvec({EMBEDDING_DIM})":
+        # O índice existente usa a classe de operadores do tipo antigo
+        await conn.execute("DROP INDEX IF EXISTS ix_langchain_pg_embedding_hnsw")
+        await conn.execute(
+            f"ALTER TABLE langchain_pg_embedding ALTER COLUMN embedding "
+            f"TYPE halfvec({EMBEDDING_DIM}) USING embedding::halfvec({EMBEDDING_DIM})"
+        )
+
+
+async def _copy_embeddings(conn, collection, ids, texts, vectors, metadatas):
+    # Grava os pedaços via COPY binário (vetores como float2, sem conversão para texto)
+    (collection_id,) = await (await conn.execute(
+        "SELECT uuid FROM langchain_pg_collection WHERE name = %s", (collection,)
+    )).fetchone()
+    async with conn.cursor() as cur:
+        # COPY não faz upsert: remove antes todos os pedaços da coleção (inclusive os que
+        # sobrariam de uma ingestão anterior com mais pedaços), sem tocar em outras coleções
+        await cur.execute("DELETE FROM langchain_pg_embedding WHERE collection_id = %s", (collection_id,))
+        async with cur.copy(
+            "COPY langchain_pg_embedding (id, collection_id, embedding, document, cmetadata) "
+            "FROM STDIN (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["varchar", "uuid", "halfvec", "varchar", "jsonb"])
+            for doc_id, document, vector, metadata in zip(ids, texts, vectors, metadatas):
+                await copy.write_row((doc_id, collection_id, HalfVector(vector), document, Jsonb(metadata)))
+
+
+async def _create_indexes(conn):
+    # Índice HNSW por produto interno sobre a coluna halfvec (halfvec_ip_ops)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_hnsw ON langchain_pg_embedding "
+        "USING hnsw (embedding halfvec_ip_ops) WITH (m = 16, ef_construction = 64)"
+    )
+    # Índice GIN para a busca textual (full-text) usada na recuperação híbrida
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_fts ON langchain_pg_embedding "
+        "USING gin (to_tsvector('portuguese', document))"
+    )
+
+
+async def _ingest_async():
+    # Carrega o PDF e divide o documento em pedaços menores
+    splits = _load_splits()
     if not splits:
         raise RuntimeError("Erro: não foram criados os pedaços do PDF.")
     print(f"Criados {len(splits)} pedaços do PDF.")
     
-    # Enriquecer com metadados
-    enriched = [
-        Document(
-            page_content=d.page_content,
-            metadata={k: v for k, v in d.metadata.items() if v not in ("", None)}
-        )
-        for d in splits
-    ]
+    # Textos e metadados (sem valores vazios) em listas paralelas, sem novos Documents intermediários
+    texts = [d.page_content for d in splits]
+    metadatas = [{k: v for k, v in d.metadata.items() if v is not None and v != ""} for d in splits]
 
-    # Criar os índices para cada pedaço
-    ids = [f"doc-{i}" for i in range(len(enriched))]
-    
-    # Criar os vetores
-    embeddings = OpenAIEmbeddings(model=os.getenv("OPENAI_MODEL","text-embedding-3-small"))
+    # Criar os índices para cada pedaço (o id é chave primária global da tabela,
+    # por isso leva o nome da coleção)
+    collection = os.environ["PGVECTOR_COLLECTION"]
+    ids = [f"{collection}-doc-{i}" for i in range(len(splits))]
     
-    # Armazenar no PGVector
-    store = PGVector(
+    # Criar os vetores em lotes paralelos (uma chamada à API a cada EMBEDDING_BATCH_SIZE pedaços);
+    # pedaços já vetorizados em execuções anteriores são lidos do cache em disco
+    embedding_model = os.getenv("OPENAI_MODEL","text-embedding-3-small")
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        OpenAIEmbeddings(model=embedding_model, chunk_size=EMBEDDING_BATCH_SIZE, show_progress_bar=False),
+        LocalFileStore(EMBEDDING_CACHE_DIR),
+        namespace=embedding_model,
+        key_encoder="sha256",
+    )
+    vectors = normalize(await _embed_documents(embeddings, texts))
+
+    # O PGVector garante a extensão, as tabelas e a coleção (distância por produto interno:
+    # vetores da OpenAI são unitários)
+    PGVector(
         embeddings=embeddings,
-        collection_name=os.environ["PGVECTOR_COLLECTION"],
+        collection_name=collection,
         connection=os.environ["DATABASE_URL"],
+        embedding_length=EMBEDDING_DIM,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
         use_jsonb=True,
     )
-    store.add_documents(documents=enriched, ids=ids)
+
+    # Armazenar no PGVector os vetores já calculados, via COPY binário do psycopg
+    conninfo = make_url(os.environ["DATABASE_URL"]).set(drivername="postgresql").render_as_string(hide_password=False)
+    async with await AsyncConnection.connect(conninfo) as conn:
+        await register_vector_async(conn)
+        await _prepare_schema(conn)
+        await _copy_embeddings(conn, collection, ids, texts, vectors, metadatas)
+
+        # Criar os índices após a carga (construção em bloco é mais rápida)
+        await _create_indexes(conn)
+
+
+def ingest_pdf():
+    asyncio.run(_ingest_async())
 
 if __name__ == "__main__":
     ingest_pdf()
\ No newline at end of file
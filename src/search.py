@@ -3,16 +3,29 @@
 #  Autor.........: Rogério Martins
 #  Descrição.....: Módulo de busca e recuperação com RAG usando PGVector
 #  Criado em.....: 25/10/2025
-#  Última alteração: 25/10/2025
+#  Última alteração: 15/10/2026
 # ========================================================================
 
+import asyncio
 import os
-from typing import List, Tuple, Callable
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple, Callable
 from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
 
+import numpy as np
 from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain_postgres import PGVector
+from langchain_postgres.vectorstores import DistanceStrategy
 
 PROMPT_TEMPLATE = """
 CONTEXTO:
@@ -20,20 +33,22 @@ CONTEXTO:
 
 REGRAS:
 - Responda somente com base no CONTEXTO.
-- Se a informação não estiver explicitamente no CONTEXTO, responda:
-  "Não tenho informações necessárias para responder sua pergunta."
+- A primeira linha da resposta deve ser exatamente SIM, se a informação estiver
+  explicitamente no CONTEXTO, ou NAO, caso contrário.
+- Se a primeira linha for NAO, não escreva mais nada.
+- Se a primeira linha for SIM, escreva a resposta a partir da linha seguinte.
 - Nunca invente ou use conhecimento externo.
 - Nunca produza opiniões ou interpretações além do que está escrito.
 
-EXEMPLOS DE PERGUNTAS FORA DO CONTEXTO:
+EXEMPLOS DE PERGUNTAS FORA DO CONTEXTO (a linha abaixo de cada pergunta é a saída completa):
 Pergunta: "Qual é a capital da França?"
-Resposta: "Não tenho informações necessárias para responder sua pergunta."
+NAO
 
 Pergunta: "Quantos clientes temos em 2024?"
-Resposta: "Não tenho informações necessárias para responder sua pergunta."
+NAO
 
 Pergunta: "Você acha isso bom ou ruim?"
-Resposta: "Não tenho informações necessárias para responder sua pergunta."
+NAO
 
 PERGUNTA DO USUÁRIO:
 {pergunta}
@@ -41,9 +56,73 @@ PERGUNTA DO USUÁRIO:
 RESPONDA A "PERGUNTA DO USUÁRIO"
 """
 
+# Template de prompt pré-compilado (parseado uma única vez no carregamento do módulo)
+_PROMPT = ChatPromptTemplate.from_template(PROMPT_TEMPLATE.strip())
+
 # Resposta padrão quando não há evidência suficiente no contexto
 DEFAULT_NOINFO = 'Não tenho informações necessárias para responder sua pergunta.'
 
+# Veredito (SIM/NAO) ocupando sozinho a primeira linha da resposta da LLM, tolerando
+# pontuação/markdown e um rótulo "Resposta:"; "Não, ..." na mesma linha não é veredito
+_VERDICT_RE = re.compile(r"^\W*(?:resposta\W*)?(SIM|N[AÃ]O)\b[ \t.:;,!*_\-–—]*(?:\r?\n|\Z)", re.IGNORECASE)
+
+# Quantidade de caracteres lidos do streaming antes de desistir de encontrar o veredito
+_VERDICT_MAX_CHARS = 16
+
+# Engines SQLAlchemy (com pool de conexões) compartilhadas por DSN
+_ENGINES: Dict[str, Engine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+# Clientes do pipeline RAG (embeddings, store, llm), criados uma única vez por processo
+_CLIENTS: Tuple | None = None
+_CLIENTS_LOCK = threading.Lock()
+
+# Executor compartilhado para rodar em paralelo as buscas vetorial e textual
+_RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+# Constante de suavização do Reciprocal Rank Fusion
+RRF_K = 60
+
+# MMR na busca vetorial: busca MMR_FETCH_FACTOR * k candidatos e seleciona k equilibrando
+# relevância e diversidade (env MMR_LAMBDA: 1 = só relevância, 0 = só diversidade)
+MMR_FETCH_FACTOR = 3
+
+
+def _ef_search() -> int:
+    """
+    Valor de hnsw.ef_search das conexões: HNSW_EF_SEARCH, mas nunca menor que os candidatos
+    pedidos pelo MMR para TOPK (uma busca HNSW devolve no máximo ef_search linhas).
+    """
+    return max(int(os.getenv("HNSW_EF_SEARCH", "40")), MMR_FETCH_FACTOR * int(os.getenv("TOPK", "10")))
+
+# Busca textual (full-text search do Postgres) restrita à coleção, atendida pelo índice GIN da ingestão.
+# Os termos da pergunta são combinados com OU (o plainto_tsquery exigiria todos), e o ts_rank
+# ordena os trechos pela quantidade de termos encontrados. A coluna all_terms indica se o trecho
+# contém todos os termos da pergunta (correspondência forte).
+_KEYWORD_SEARCH_SQL = text("""
+WITH query AS (
+    SELECT plainto_tsquery('portuguese', :q) AS all_terms,
+           CAST(replace(plainto_tsquery('portuguese', :q)::text, ' & ', ' | ') AS tsquery) AS any_term
+)
+SELECT e.id, e.document, e.cmetadata,
+       to_tsvector('portuguese', e.document) @@ query.all_terms AS all_terms
+FROM langchain_pg_embedding e
+JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+CROSS JOIN query
+WHERE c.name = :collection
+  AND to_tsvector('portuguese', e.document) @@ query.any_term
+ORDER BY ts_rank(to_tsvector('portuguese', e.document), query.any_term) DESC
+LIMIT :k
+""")
+
+
+def _page_part(page) -> str:
+    return "" if page is None else f" | page={page}"
+
+
+def _src_part(source) -> str:
+    return f" | src={source}" if source else ""
+
 
 def _format_context(docs_with_scores: List[Tuple[Document, float]]) -> str:
     """
@@ -57,34 +136,237 @@ def _format_context(docs_with_scores: List[Tuple[Document, float]]) -> str:
     """
     if not docs_with_scores:
         return ""
-    parts = []
-    for i, (doc, score) in enumerate(docs_with_scores, start=1):
+    parts = [None] * len(docs_with_scores)
+    for i, (doc, score) in enumerate(docs_with_scores):
         meta = doc.metadata or {}
-        page = meta.get("page")
-        source = meta.get("source") or meta.get("file_path") or ""
-        header = f"[Trecho {i} | score={score:.4f}"
-        if page is not None:
-            header += f" | page={page}"
-        if source:
-            header += f" | src={source}"
-        header += "]"
-        parts.append(f"{header}\n{doc.page_content.strip()}\n")
+        content = doc.page_content
+        # Só copia o conteúdo com strip() quando há espaço nas bordas
+        if content[:1].isspace() or content[-1:].isspace():
+            content = content.strip()
+        parts[i] = (
+            f"[Trecho {i + 1} | score={score:.4f}"
+            f"{_page_part(meta.get('page'))}"
+            f"{_src_part(meta.get('source') or meta.get('file_path'))}]\n{content}\n"
+        )
     return "\n".join(parts)
 
 
+def _keyword_search(
+    engine: Engine, collection: str, q: str, k: int
+) -> Tuple[List[Tuple[Document, float]], bool]:
+    """
+    Busca os k trechos da coleção mais relevantes para 'q' por palavras-chave (ts_rank).
+
+    Retorno:
+        (hits, all_terms): lista de tuplas (Document, posição no ranking textual, a partir de 1)
+        e se algum trecho contém todos os termos da pergunta.
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(_KEYWORD_SEARCH_SQL, {"q": q, "collection": collection, "k": k}).all()
+    hits = [
+        (Document(id=row.id, page_content=row.document, metadata=row.cmetadata or {}), float(rank))
+        for rank, row in enumerate(rows, start=1)
+    ]
+    return hits, any(row.all_terms for row in rows)
+
+
+def _rrf_fuse(*rankings: List[Tuple[Document, float]], k: int) -> List[Tuple[Document, float]]:
+    """
+    Combina rankings (já ordenados do mais ao menos relevante) com Reciprocal Rank Fusion.
+
+    Retorno:
+        Os k documentos de maior score RRF, como tuplas (Document, score RRF).
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking, start=1):
+            key = doc.id or doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [(docs[key], score) for key, score in best]
+
+
+def _hybrid_search(
+    store, engine: Engine, query_vector: List[float], q: str, k: int, max_distance: float
+) -> List[Tuple[Document, float]]:
+    """
+    Executa em paralelo a busca vetorial (PGVector) e a textual (full-text) e funde os resultados por RRF.
+
+    A busca vetorial usa Maximal Marginal Relevance, descartando trechos quase duplicados
+    (mesma página, janelas sobrepostas) que só aumentariam os tokens enviados à LLM.
+
+    O psycopg libera a GIL durante o I/O, então a latência total fica próxima à da busca mais lenta.
+
+    Se nem o trecho mais próximo da busca vetorial estiver a uma distância de cosseno <= 'max_distance',
+    a pergunta é considerada fora do documento e nada é retornado (evita chamar a LLM à toa).
+    A exceção é uma correspondência textual forte (um trecho com todos os termos da pergunta),
+    comum em perguntas curtas como um nome próprio; um único termo em comum não basta.
+    """
+    # Não pede mais candidatos do que o índice HNSW consegue devolver (hnsw.ef_search)
+    vector_future = _RETRIEVAL_EXECUTOR.submit(
+        store.max_marginal_relevance_search_with_score_by_vector,
+        query_vector,
+        k=k,
+        fetch_k=max(k, min(MMR_FETCH_FACTOR * k, _ef_search())),
+        lambda_mult=float(os.getenv("MMR_LAMBDA", "0.5")),
+    )
+    keyword_future = _RETRIEVAL_EXECUTOR.submit(_keyword_search, engine, store.collection_name, q, k)
+    vector_hits = vector_future.result()
+    keyword_hits, all_terms = keyword_future.result()
+
+    # O score do produto interno é -<a, b>; para vetores unitários, distância de cosseno = 1 + score
+    if not all_terms and vector_hits and 1.0 + min(score for _, score in vector_hits) > max_distance:
+        return []
+    return _rrf_fuse(vector_hits, keyword_hits, k=k)
+
+
+def normalize(vectors: List[List[float]]) -> np.ndarray:
+    """
+    Normaliza os vetores para norma 1, de modo que o produto interno (<#>) equivalha ao cosseno.
+
+    Os embeddings da OpenAI são apenas aproximadamente unitários; usado tanto na ingestão
+    (vetores gravados) quanto na busca (vetores das perguntas).
+
+    Retorno:
+        Matriz float32 (n, dim) com uma linha por vetor.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _build_prompt(contexto: str, pergunta: str) -> List[BaseMessage]:
+    """Injeta o contexto e a pergunta no PROMPT_TEMPLATE pré-compilado, gerando as mensagens da LLM."""
+    return _PROMPT.format_messages(contexto=contexto, pergunta=pergunta)
+
+
+def _split_verdict(content: str) -> Tuple[bool | None, str]:
+    """
+    Separa o veredito (SIM/NAO) do início da resposta da LLM do restante do texto.
+
+    O veredito só é reconhecido quando ocupa sozinho a primeira linha; uma resposta
+    que apenas começa com "Sim"/"Não" (ex.: "Não, a empresa ...") é usada integralmente.
+
+    Retorno:
+        (True, resposta) para SIM, (False, "") para NAO, ou (None, content) se a
+        LLM não tiver seguido o formato (o conteúdo é usado integralmente).
+    """
+    match = _VERDICT_RE.match(content)
+    if match is None:
+        return None, content
+    if match.group(1).upper() == "SIM":
+        return True, content[match.end():]
+    return False, ""
+
+
+def _extract_answer(resp) -> str:
+    """Extrai o texto da resposta da LLM, com fallback para DEFAULT_NOINFO."""
+    _, answer = _split_verdict(resp.content or "")
+    answer = answer.strip()
+    return answer if answer else DEFAULT_NOINFO
+
+
+class _SemanticCache:
+    """
+    Cache semântico de respostas em memória (padrão GPTCache).
+
+    Guarda pares (vetor unitário da pergunta, k, resposta) e devolve a resposta de uma pergunta
+    anterior, feita com o mesmo k, cuja similaridade de cosseno com a nova seja >= 'threshold',
+    evitando uma nova chamada à LLM para repetições e paráfrases.
+
+    Os vetores ficam numa matriz (maxsize, dim) pré-alocada, usada como buffer circular:
+    a consulta é um único produto matriz-vetor, sem cópias a cada pergunta.
+
+    Parâmetros:
+        threshold: similaridade mínima de cosseno para considerar um acerto.
+        maxsize: quantidade máxima de entradas (as mais antigas são sobrescritas).
+    """
+
+    def __init__(self, threshold: float, maxsize: int = 1024):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._matrix: np.ndarray | None = None
+        self._ks = np.zeros(maxsize, dtype=np.int32)
+        self._answers: List[str | None] = [None] * maxsize
+        self._size = 0
+        self._next = 0
+
+    def lookup(self, vector: List[float], k: int) -> str | None:
+        """Retorna a resposta em cache mais similar a 'vector' para o mesmo k, ou None se não houver acerto."""
+        if not self._size:
+            return None
+        sims = self._matrix[:self._size] @ np.asarray(vector, dtype=np.float32)
+        sims[self._ks[:self._size] != k] = -np.inf
+        best = int(np.argmax(sims))
+        return self._answers[best] if sims[best] >= self.threshold else None
+
+    def add(self, vector: List[float], k: int, answer: str) -> None:
+        """Registra a resposta 'answer' para a pergunta vetorizada em 'vector', recuperada com top-k."""
+        v = np.asarray(vector, dtype=np.float32)
+        if self._matrix is None:
+            self._matrix = np.empty((self.maxsize, v.shape[0]), dtype=np.float32)
+        self._matrix[self._next] = v
+        self._ks[self._next] = k
+        self._answers[self._next] = answer
+        self._next = (self._next + 1) % self.maxsize
+        self._size = min(self._size + 1, self.maxsize)
+
+
+def _get_engine(dsn: str) -> Engine:
+    """
+    Retorna a engine SQLAlchemy associada a 'dsn', criando-a na primeira chamada.
+
+    A engine mantém um pool de conexões reaproveitado entre chamadas de search_prompt(),
+    evitando pagar o handshake TCP/TLS/autenticação do Postgres a cada nova instância do PGVector.
+    """
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(dsn)
+        if engine is None:
+            engine = create_engine(dsn, pool_size=10, max_overflow=5, pool_pre_ping=True)
+            ef_search = _ef_search()
+
+            @event.listens_for(engine, "connect")
+            def _set_ef_search(dbapi_connection, _):
+                # Ajuste de recall x latência do índice HNSW, válido para toda a sessão
+                with dbapi_connection.cursor() as cur:
+                    cur.execute(f"SET hnsw.ef_search = {ef_search}")
+                dbapi_connection.commit()
+
+            _ENGINES[dsn] = engine
+        return engine
+
+
 def _load_clients():
     """
     Carrega variáveis de ambiente e instancia clientes necessários ao pipeline RAG.
 
+    Os clientes são criados apenas na primeira chamada; as seguintes reaproveitam a mesma
+    instância (sem recarregar o .env nem refazer conexões com OpenAI e Postgres).
+
     Fluxo:
         - Garante presença das variáveis críticas (.env).
-        - Cria o cliente de embeddings (OpenAIEmbeddings).
-        - Cria o vetor store PGVector (conexão Postgres informada em DATABASE_URL).
+        - Cria o cliente de embeddings (OpenAIEmbeddings) com cache em disco (EMBEDDING_CACHE_DIR).
+        - Cria o vetor store PGVector (pool de conexões compartilhado para o DATABASE_URL),
+          com distância por produto interno, atendida pelo índice HNSW criado na ingestão.
+          A coluna é halfvec (FP16): o vetor da consulta é convertido implicitamente pelo Postgres.
         - Cria o cliente de chat LLM (ChatOpenAI).
 
     Retorno:
         (embeddings, store, llm)
     """
+    global _CLIENTS
+    if _CLIENTS is not None:
+        return _CLIENTS
+
+    with _CLIENTS_LOCK:
+        if _CLIENTS is None:
+            _CLIENTS = _create_clients()
+        return _CLIENTS
+
+
+def _create_clients():
     load_dotenv()
 
     for k in ("OPENAI_API_KEY", "DATABASE_URL", "PGVECTOR_COLLECTION"):
@@ -95,48 +377,106 @@ def _load_clients():
     chat_model = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
     temperature = float(os.getenv("OPENAI_TEMPERATURE", "0"))
 
-    embeddings = OpenAIEmbeddings(model=embedding_model)
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        OpenAIEmbeddings(model=embedding_model),
+        LocalFileStore(os.getenv("EMBEDDING_CACHE_DIR", "./.emb_cache")),
+        namespace=embedding_model,
+        query_embedding_cache=True,
+        key_encoder="sha256",
+    )
+    engine = _get_engine(os.environ["DATABASE_URL"])
     store = PGVector(
         embeddings=embeddings,
         collection_name=os.environ["PGVECTOR_COLLECTION"],
-        connection=os.environ["DATABASE_URL"],
+        connection=engine,
+        embedding_length=int(os.getenv("EMBEDDING_DIM", "1536")),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
         use_jsonb=True,
     )
-    llm = ChatOpenAI(model=chat_model, temperature=temperature)
+    llm = ChatOpenAI(model=chat_model, temperature=temperature, streaming=True)
+
+    # Verificação rápida (LIMIT 0) de que a consulta textual é aceita pelo Postgres:
+    # um erro de SQL aparece na inicialização, e não a cada pergunta
+    _keyword_search(engine, store.collection_name, "verificação", 0)
 
     return embeddings, store, llm
 
 
-def search_prompt(question: str | None = None) -> Callable[[str, int], str] | str:
+def search_prompt(
+    question: str | None = None, stream: bool = False
+) -> Callable[[str, int], str | Iterator[str]] | str | Iterator[str]:
     """
     Constrói a cadeia de pesquisa e resposta (RAG) ou executa-a imediatamente.
 
     Comportamentos:
         - Se 'question' for None:
             retorna uma função `chain(q: str, k: int = 10) -> str` que:
-                1) vetoriza q e busca top-k no PGVector,
+                1) vetoriza q (com cache) e busca top-k no PGVector (vetorial + textual, via RRF),
                 2) formata o contexto,
                 3) injeta no PROMPT_TEMPLATE,
                 4) chama a LLM e retorna a resposta (ou DEFAULT_NOINFO).
         - Se 'question' for str:
             executa imediatamente a mesma cadeia e retorna a resposta.
+        - Se 'stream' for True, usa `chain_stream(q, k)`, que devolve a resposta em
+          pedaços (iterador de str) conforme a LLM gera os tokens.
 
     Parâmetros:
         question: pergunta opcional para execução imediata.
+        stream: se True, a resposta é entregue em streaming.
 
     Retorno:
-        Função `chain(...)` pronta para uso interativo OU a string de resposta.
+        Função `chain(...)`/`chain_stream(...)` pronta para uso interativo OU a resposta.
     """
     embeddings, store, llm = _load_clients()
+    engine = _get_engine(os.environ["DATABASE_URL"])
+
+    # Distância de cosseno acima da qual os trechos são considerados irrelevantes para a pergunta
+    noinfo_threshold = float(os.getenv("NOINFO_THRESHOLD", "0.7"))
+
+    # Perguntas repetidas na mesma sessão não voltam à API de embeddings
+    @lru_cache(maxsize=1024)
+    def embed_query(q: str) -> List[float]:
+        return normalize([embeddings.embed_query(q)])[0].tolist()
+
+    # Paráfrases de perguntas já respondidas reaproveitam a resposta sem chamar a LLM
+    semantic_cache = _SemanticCache(threshold=float(os.getenv("SEM_CACHE_THRESHOLD", "0.97")))
+
+    def prepare(q: str, k: int):
+        """
+        Etapas 0–3 do pipeline, comuns a `chain` e `chain_stream`.
+
+        Retorno:
+            (query_vector, messages, answer): 'answer' é preenchido quando a resposta
+            já é conhecida (cache semântico ou sem contexto) e a LLM não precisa ser chamada.
+        """
+        # 0) Cache semântico de respostas
+        query_vector = embed_query(q)
+        cached = semantic_cache.lookup(query_vector, k)
+        if cached is not None:
+            return query_vector, None, cached
+
+        # 1) Recuperação híbrida (similaridade no PGVector + palavras-chave)
+        docs_with_scores = _hybrid_search(store, engine, query_vector, q, k, noinfo_threshold)
+
+        # 2) Formatação do contexto
+        contexto = _format_context(docs_with_scores)
+
+        # Short-circuit: sem contexto relevante, respeite as regras e não invente
+        if not contexto.strip():
+            return query_vector, None, DEFAULT_NOINFO
+
+        # 3) Mensagens a partir do template pré-compilado
+        return query_vector, _build_prompt(contexto, q), None
 
     def chain(q: str, k: int = 10) -> str:
         """
         Executa o pipeline RAG completo para a pergunta 'q'.
 
         Etapas:
-            1) Busca vetorial (top-k) no PGVector com base na pergunta.
+            0) Consulta o cache semântico; em caso de acerto, retorna a resposta já conhecida.
+            1) Busca híbrida (top-k): vetorial (MMR) no PGVector e textual em paralelo, fundidas por RRF.
             2) Monta o CONTEXTO a partir dos trechos retornados.
-            3) Formata o PROMPT_TEMPLATE com (contexto, pergunta).
+            3) Formata o PROMPT_TEMPLATE (pré-compilado) com (contexto, pergunta).
             4) Invoca a LLM e retorna o conteúdo textual.
 
         Parâmetros:
@@ -146,29 +486,201 @@ def search_prompt(question: str | None = None) -> Callable[[str, int], str] | st
         Retorno:
             Resposta da LLM, ou DEFAULT_NOINFO se não houver contexto suficiente.
         """
-        # 1) Recuperação por similaridade (PGVector)
-        docs_with_scores = store.similarity_search_with_score(q, k=k)
+        query_vector, messages, answer = prepare(q, k)
+        if answer is not None:
+            return answer
 
-        # 2) Formatação do contexto
-        contexto = _format_context(docs_with_scores)
+        # 4) Chamada à LLM (com fallback defensivo)
+        answer = _extract_answer(llm.invoke(messages))
+        semantic_cache.add(query_vector, k, answer)
+        return answer
 
-        # Short-circuit: sem contexto, respeite as regras e não invente
-        if not contexto.strip():
-            return DEFAULT_NOINFO
+    def chain_stream(q: str, k: int = 10) -> Iterator[str]:
+        """
+        Mesmo pipeline de `chain`, mas entrega a resposta da LLM em pedaços, à medida que é gerada.
 
-        # 3) Prompt a partir do template fornecido
-        prompt = PROMPT_TEMPLATE.format(contexto=contexto, pergunta=q).strip()
+        Parâmetros:
+            q: pergunta do usuário.
+            k: quantidade de resultados mais relevantes a recuperar (default=10).
 
-        # 4) Chamada à LLM
-        resp = llm.invoke(prompt)
-        answer = (resp.content or "").strip()
+        Retorno:
+            Iterador de pedaços de texto da resposta (ou DEFAULT_NOINFO em um único pedaço).
+        """
+        query_vector, messages, answer = prepare(q, k)
+        if answer is not None:
+            yield answer
+            return
+
+        # 4) Chamada à LLM em streaming: lê primeiro a linha de veredito (SIM/NAO)
+        stream = iter(llm.stream(messages))
+        head = ""
+        for chunk in stream:
+            head += chunk.content or ""
+            stripped = head.lstrip()
+            if "\n" in stripped or len(stripped) > _VERDICT_MAX_CHARS:
+                break
+        answerable, body = _split_verdict(head)
+
+        # NAO: interrompe a geração logo após o veredito
+        if answerable is False:
+            stream.close()
+            semantic_cache.add(query_vector, k, DEFAULT_NOINFO)
+            yield DEFAULT_NOINFO
+            return
+
+        body = body.lstrip()
+        tokens = [body]
+        if body:
+            yield body
+        for chunk in stream:
+            if chunk.content:
+                tokens.append(chunk.content)
+                yield chunk.content
 
         # Fallback defensivo
-        return answer if answer else DEFAULT_NOINFO
+        answer = "".join(tokens).strip()
+        if not answer:
+            answer = DEFAULT_NOINFO
+            yield answer
+        semantic_cache.add(query_vector, k, answer)
 
+    run = chain_stream if stream else chain
     if question is None:
-        return chain
+        return run
     else:
         # Execução imediata com k definido via env (TOPK) ou padrão 10
-        return chain(question, k=int(os.getenv("TOPK", "10")))
+        return run(question, k=int(os.getenv("TOPK", "10")))
+
+
+class QueryProcessor:
+    """
+    Processa perguntas concorrentes em lotes, sobre o mesmo pipeline RAG de `chain()`.
 
+    As perguntas enviadas via `await ask(q)` entram numa fila; um worker em segundo plano
+    agrupa até 'batch_size' itens (ou o que chegar em 'flush_ms' milissegundos) e, para o lote:
+        1) vetoriza todas as perguntas numa única chamada de embeddings,
+        2) executa as buscas híbridas no PGVector em paralelo (threads para cada busca),
+        3) envia todos os prompts de uma vez com `llm.abatch`.
+
+    Deve ser usado sempre dentro do mesmo event loop.
+
+    Parâmetros:
+        embeddings, store, llm: clientes retornados por _load_clients().
+        batch_size: quantidade máxima de perguntas por lote.
+        flush_ms: tempo máximo de espera (ms) para completar um lote.
+    """
+
+    def __init__(self, embeddings, store, llm, batch_size: int = 16, flush_ms: int = 80):
+        self._embeddings = embeddings
+        self._store = store
+        self._llm = llm
+        self._engine = _get_engine(os.environ["DATABASE_URL"])
+        self._noinfo_threshold = float(os.getenv("NOINFO_THRESHOLD", "0.7"))
+        self._batch_size = batch_size
+        self._flush_s = flush_ms / 1000
+        self._semantic_cache = _SemanticCache(threshold=float(os.getenv("SEM_CACHE_THRESHOLD", "0.97")))
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+
+    async def ask(self, q: str, k: int = 10) -> str:
+        """Enfileira a pergunta 'q' e aguarda a resposta (ou DEFAULT_NOINFO)."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((q, k, future))
+        return await future
+
+    async def close(self) -> None:
+        """Encerra o worker em segundo plano, cancelando as perguntas ainda pendentes."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        # Perguntas que ainda não entraram em nenhum lote
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, future = self._queue.get_nowait()
+                future.cancel()
+            self._queue = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self._queue.get())
+                deadline = loop.time() + self._flush_s
+                while len(batch) < self._batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                try:
+                    answers = await self._process(batch)
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, _, future), answer in zip(batch, answers):
+                        if not future.done():
+                            future.set_result(answer)
+            except asyncio.CancelledError:
+                # close() durante a montagem ou o processamento de um lote: libera quem aguarda
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+
+    async def _process(self, batch) -> List[str]:
+        # 0) Vetorização do lote e cache semântico de respostas
+        vectors = normalize(await self._embeddings.aembed_documents([q for q, _, _ in batch])).tolist()
+        answers: List[str | None] = [self._semantic_cache.lookup(v, k) for v, (_, k, _) in zip(vectors, batch)]
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+
+        # 1) Buscas híbridas no PGVector em paralelo
+        results = await asyncio.gather(*(
+            asyncio.to_thread(
+                _hybrid_search, self._store, self._engine, vectors[i], batch[i][0], batch[i][1], self._noinfo_threshold
+            )
+            for i in pending
+        ))
+
+        # 2) e 3) Contexto e prompt de cada pergunta
+        prompts = {}
+        for i, docs_with_scores in zip(pending, results):
+            contexto = _format_context(docs_with_scores)
+            if not contexto.strip():
+                answers[i] = DEFAULT_NOINFO
+            else:
+                prompts[i] = _build_prompt(contexto, batch[i][0])
+
+        # 4) Uma única rodada de chamadas à LLM para o lote
+        if prompts:
+            responses = await self._llm.abatch(list(prompts.values()))
+            for i, resp in zip(prompts, responses):
+                answers[i] = _extract_answer(resp)
+                self._semantic_cache.add(vectors[i], batch[i][1], answers[i])
+        return answers
+
+
+def build_query_processor() -> QueryProcessor:
+    """
+    Cria um QueryProcessor com os clientes do pipeline RAG.
+
+    O tamanho do lote e a janela de espera vêm de QUERY_BATCH_SIZE (default=16)
+    e QUERY_FLUSH_MS (default=80).
+    """
+    return QueryProcessor(
+        *_load_clients(),
+        batch_size=int(os.getenv("QUERY_BATCH_SIZE", "16")),
+        flush_ms=int(os.getenv("QUERY_FLUSH_MS", "80")),
+    )